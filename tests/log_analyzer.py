@@ -1,9 +1,12 @@
+import io
 import os
+import json
+import gzip
+import tempfile
 import unittest
 import logging
 from datetime import date
 from unittest import mock
-from collections import namedtuple
 
 import log_analyzer as analyzer
 
@@ -11,18 +14,32 @@ import log_analyzer as analyzer
 logging.disable(logging.CRITICAL)
 
 
+class DirEntryStub:
+    def __init__(self, dir_path, name, is_file=True):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._is_file = is_file
+
+    def is_file(self):
+        return self._is_file
+
+
+def stub_scandir(scandir_mock, dir_path, names, dir_names=()):
+    entries = [DirEntryStub(dir_path, name) for name in names]
+    entries += [DirEntryStub(dir_path, name, is_file=False) for name in dir_names]
+    scandir_mock.return_value.__enter__.return_value = entries
+
+
 class LogAnalyzerTest(unittest.TestCase):
     def setUp(self):
-        LogFile = namedtuple('LogFile', 'path, date')
-
-        self.log20170630 = LogFile(
+        self.log20170630 = analyzer.LogFile(
             path='nginx-access-ui.log-20170630',
             date=date(2017, 6, 30),
         )
 
-    @mock.patch.object(os, 'listdir')
-    def test_search_log(self, listdir_mock):
-        listdir_mock.return_value = [
+    @mock.patch.object(os, 'scandir')
+    def test_search_log(self, scandir_mock):
+        stub_scandir(scandir_mock, '/logs', [
             'file'
             'file20180630'
             'aanginx-access-ui.log-20170631',
@@ -32,20 +49,41 @@ class LogAnalyzerTest(unittest.TestCase):
             'nginx-access-ui.log-20180631.bz2',
             'nginx-access-ui.log-20180631ff',
             'nginx-access-ui.log-20180631ff.tar',
-        ]
+        ])
 
         log = set(analyzer.find_latest_log('/logs'))
         expected = {date(2018, 6, 30), '/logs/nginx-access-ui.log-20180630.gz'}
 
         self.assertSetEqual(log, expected)
 
-    @mock.patch.object(os, 'listdir')
-    def test_search_log_along_other_files(self, listdir_mock):
-        listdir_mock.return_value = [
+    @mock.patch.object(os, 'scandir')
+    def test_search_log_with_invalid_date(self, scandir_mock):
+        stub_scandir(scandir_mock, '/logs', [
+            'nginx-access-ui.log-20170630',
+            'nginx-access-ui.log-20171340.gz',
+        ])
+        log = analyzer.find_latest_log('/logs')
+
+        self.assertEqual(log.path, '/logs/nginx-access-ui.log-20170630')
+
+    @mock.patch.object(os, 'scandir')
+    def test_search_log_skipping_directories(self, scandir_mock):
+        stub_scandir(
+            scandir_mock, '/logs',
+            names=['nginx-access-ui.log-20170630'],
+            dir_names=['nginx-access-ui.log-20180630'],
+        )
+        log = analyzer.find_latest_log('/logs')
+
+        self.assertEqual(log.path, '/logs/nginx-access-ui.log-20170630')
+
+    @mock.patch.object(os, 'scandir')
+    def test_search_log_along_other_files(self, scandir_mock):
+        stub_scandir(scandir_mock, '/logs', [
             'file',
             'file2',
             'file20170630',
-        ]
+        ])
         log = analyzer.find_latest_log('/logs')
 
         self.assertEqual(log, None)
@@ -55,6 +93,24 @@ class LogAnalyzerTest(unittest.TestCase):
 
         self.assertEqual(median, 3)
 
+    def test_oversized_time_collecting(self):
+        log_lines = [
+            '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "GET /api/v2/group/482920 HTTP/1.1" 200 836 "-" "-" "-" "-" "-" 5000000.000\n',
+        ]
+        times = analyzer.collect_times_for_urls(analyzer.parse_lines(log_lines))
+
+        self.assertEqual(list(times.get('/api/v2/group/482920')), [5000000.0])
+
+    def test_times_stats(self):
+        stats = analyzer.calc_times_stats([4, 1, 3, 2])
+
+        self.assertTupleEqual(stats, (4, 10, 4, 2.5, 2.5))
+
+    def test_single_time_stats(self):
+        stats = analyzer.calc_times_stats([0.5])
+
+        self.assertTupleEqual(stats, (1, 0.5, 0.5, 0.5, 0.5))
+
     def test_lines_parsing(self):
         log_lines = [
             '1.199.168.112 2a828197ae235b0b3cb  - [29/Jun/2017:03:50:44 +0300] "GET /api/1/banners/?campaign=6607623 HTTP/1.1" 200 1130 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697444-2760328665-4709-9929070" "-" 0.767',
@@ -62,35 +118,83 @@ class LogAnalyzerTest(unittest.TestCase):
             '1.194.135.240 -  - [29/Jun/2017:03:50:45 +0300] "GET /api/v2/group/6190230/statistic/sites/?date_type=day&date_from=2017-06-29&date_to=2017-06-29 HTTP/1.1" 200 22 "-" "python-requests/2.13.0" "-" "1498697445-3979856266-4709-9929081" "8a7741a54297568b" 0.065',
         ]
         parsed = list(analyzer.parse_lines(log_lines))
-        expected = {
-            'remote_addr': '1.199.168.112',
-            'remote_user': '2a828197ae235b0b3cb',
-            'http_x_real_ip': '-',
-            'time_local': '29/Jun/2017:03:50:44 +0300',
-            'request_method': 'GET',
-            'request_url': '/api/1/banners/?campaign=6607623',
-            'request_protocol': 'HTTP/1.1',
-            'status': '200',
-            'body_bytes_sent': '1130',
-            'http_referer': '-',
-            'http_user_agent': 'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
-            'http_x_forwarded_for': '-',
-            'http_X_REQUEST_ID': '1498697444-2760328665-4709-9929070',
-            'http_X_RB_USER': '-',
-            'request_time': '0.767',
-        }
+        expected = ('/api/1/banners/?campaign=6607623', 0.767)
 
         self.assertIn(expected, parsed)
 
+    def test_line_tokenizing(self):
+        token = analyzer.tokenize_line(
+            '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "GET /api/v2/group/482920 HTTP/1.1" 200 836 "-" "-" "-" "1498697445-2190034393-4709-9929080" "dc7161be3" 0.058\n'
+        )
+
+        self.assertEqual(token, ('/api/v2/group/482920', 0.058))
+
+    def test_malformed_line_tokenizing(self):
+        token = analyzer.tokenize_line(
+            '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "-" 400 0 "-" "-" "-" "-" "-" -\n'
+        )
+
+        self.assertIsNone(token)
+
+    def test_non_nginx_lines_parsing(self):
+        log_lines = [
+            '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "GET /api/v2/group/482920 HTTP/1.1" 200 836 "-" "-" "-" "-" "-" 0.058\n',
+            'garbage "GET /x HTTP/1.1" 0.5\n',
+            '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "GET /y HTTP/1.1" 0.5\n',
+        ]
+        counts = [0, 0]
+        parsed = list(analyzer.iter_parsed_lines(log_lines, counts))
+
+        self.assertListEqual(parsed, [('/api/v2/group/482920', 0.058)])
+        self.assertListEqual(counts, [3, 2])
+
+    def test_non_numeric_time_tokenizing(self):
+        line = '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "GET /api/v2/group/482920 HTTP/1.1" 200 836 "-" "-" "-" "-" "-" {}\n'
+
+        for request_time in ('nan', '-1.0', '1e5', '1_0.5', '1e999'):
+            with self.subTest(request_time=request_time):
+                self.assertIsNone(analyzer.tokenize_line(line.format(request_time)))
+
     def test_collect_times(self):
         parsed_lines = [
-            {'request_url': '/api/v1/test', 'request_time': 1},
-            {'request_url': '/api/v1/test', 'request_time': 1},
-            {'request_url': '/api/v1/test', 'request_time': 1},
+            ('/api/v1/test', 1),
+            ('/api/v1/test', 1),
+            ('/api/v1/test', 1),
         ]
         times = analyzer.collect_times_for_urls(parsed_lines)
 
-        self.assertEqual(times.get('/api/v1/test'), [1, 1, 1])
+        self.assertEqual(list(times.get('/api/v1/test')), [1, 1, 1])
+
+    def test_log_file_splitting(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'nginx-access-ui.log-20170630')
+
+            with open(log_path, 'w') as log_file:
+                log_file.write('aaa\nbbb\nccc\nddd\n')
+
+            bounds = analyzer.split_log_file(log_path, chunk_size=5)
+            chunks = [analyzer.read_log_chunk(log_path, *b) for b in bounds]
+
+        self.assertListEqual(bounds, [(0, 8), (8, 16)])
+        self.assertListEqual(chunks, [['aaa', 'bbb'], ['ccc', 'ddd']])
+
+    @mock.patch.object(analyzer, 'LOG_CHUNK_SIZE', 200)
+    def test_parallel_times_collecting(self):
+        log_line = '1.196.116.32 -  - [29/Jun/2017:03:50:45 +0300] "GET /api/v2/group/{} HTTP/1.1" 200 836 "-" "-" "-" "-" "-" 0.5\n'
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'nginx-access-ui.log-20170630')
+
+            with open(log_path, 'w') as log_file:
+                for i in range(10):
+                    log_file.write(log_line.format(i % 2))
+
+            times = analyzer.collect_times_for_log(self.log20170630._replace(path=log_path))
+
+        self.assertDictEqual(
+            {url: list(url_times) for url, url_times in times.items()},
+            {'/api/v2/group/0': [0.5] * 5, '/api/v2/group/1': [0.5] * 5},
+        )
 
     def test_requests_analyzing(self):
         times = {'/api/v1/test': [1, 1, 1]}
@@ -108,6 +212,85 @@ class LogAnalyzerTest(unittest.TestCase):
 
         self.assertListEqual(analyzed, expected)
 
+    def test_requests_sorting(self):
+        analyzed = [{'time_sum': 1}, {'time_sum': 3}, {'time_sum': 2}]
+        sorted_requests = analyzer.sort_requests_by_time_sum(analyzed, 2)
+
+        self.assertListEqual(sorted_requests, [{'time_sum': 3}, {'time_sum': 2}])
+
+    def test_gzip_log_reading(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'nginx-access-ui.log-20170630.gz')
+
+            with gzip.open(log_path, 'wt') as log_file:
+                log_file.write('first\nsecond\n')
+
+            lines = list(analyzer.get_log_lines(self.log20170630._replace(path=log_path)))
+
+        self.assertListEqual(lines, ['first\n', 'second\n'])
+
+    def test_carriage_return_log_reading(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'nginx-access-ui.log-20170630')
+
+            with open(log_path, 'wb') as log_file:
+                log_file.write(b'first\rpart\nsecond\r\n')
+
+            lines = list(analyzer.get_log_lines(self.log20170630._replace(path=log_path)))
+            chunk_lines = analyzer.read_log_chunk(log_path, 0, os.path.getsize(log_path))
+
+        self.assertListEqual(lines, ['first\rpart\n', 'second\r\n'])
+        self.assertListEqual(chunk_lines, ['first\rpart', 'second\r'])
+
+    def test_report_creating(self):
+        self.check_report_creating()
+
+    @mock.patch.object(analyzer, 'orjson', None)
+    def test_report_creating_without_orjson(self):
+        self.check_report_creating()
+
+    @mock.patch.object(os, 'sendfile', side_effect=OSError)
+    def test_report_creating_without_sendfile(self, sendfile_mock):
+        self.check_report_creating()
+
+    @mock.patch.object(os, 'sendfile', return_value=0)
+    def test_report_creating_with_short_sendfile(self, sendfile_mock):
+        self.check_report_creating()
+
+    def test_truncated_template_copying(self):
+        with tempfile.TemporaryFile() as src_file, tempfile.TemporaryFile() as dst_file:
+            src_file.write(b'short')
+            src_file.flush()
+
+            with self.assertRaises(RuntimeError):
+                analyzer.send_file_range(src_file, dst_file, 0, 10)
+
+    @mock.patch.object(analyzer, 'orjson', None)
+    def test_report_json_dumping_without_orjson(self):
+        requests = [{'url': '/a', 'count': 1}, {'url': '/b', 'count': 2}, {}]
+        report_file = io.BytesIO()
+        analyzer.dump_report_json(requests, report_file)
+
+        self.assertEqual(report_file.getvalue(), json.dumps(requests).encode())
+
+    def check_report_creating(self):
+        requests = [
+            {'url': '/api/v1/test', 'count': 3, 'time_sum': 0.767},
+            {'url': '/api/v1/тест', 'count': 1, 'time_sum': 0.058},
+        ]
+
+        with tempfile.TemporaryDirectory() as report_dir:
+            analyzer.create_report_for_log(requests, report_dir, self.log20170630)
+            report_name = analyzer.make_report_name_for_log(self.log20170630)
+
+            with open(os.path.join(report_dir, report_name)) as report_file:
+                report = report_file.read()
+
+        table_json = report.split('var table = ', 1)[1].split(';', 1)[0]
+
+        self.assertNotIn('$table_json', report)
+        self.assertListEqual(json.loads(table_json), requests)
+
     def test_report_name_making(self):
         name = analyzer.make_report_name_for_log(self.log20170630)
 